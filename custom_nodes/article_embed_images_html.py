@@ -1,12 +1,85 @@
 import os
 import re
-import base64
+from base64 import b64encode
+from functools import lru_cache
 from io import BytesIO
 
 import numpy as np
 from PIL import Image
 
 
+# 默认占位符：🖼️【图片位置：...】 / 【图片位置: ...】等
+# 】 是占位符结束符，用 [^】]* 代替 .*?，不需要 DOTALL 也不会回溯
+_DEFAULT_PATTERN = r"(?:🖼️\s*)?【图片位置[:：]\s*[^】]*】"
+# 旧版默认值，已保存的工作流里可能还带着它，同样走手写扫描
+_LEGACY_DEFAULT_PATTERN = r"(?:🖼️\s*)?【图片位置[:：]\s*.*?】"
+_PLACEHOLDER_OPEN = "【图片位置"
+_PLACEHOLDER_CLOSE = "】"
+_PLACEHOLDER_PREFIX = "🖼️"
+
+
+@lru_cache(maxsize=32)
+def _compile_pattern(pattern):
+    # 同一个自定义 pattern 在整个会话里只编译一次；
+    # 保留 DOTALL，兼容以前按 DOTALL 写的自定义正则
+    return re.compile(pattern, re.DOTALL)
+
+
+def _iter_default_placeholders(text):
+    """
+    手写扫描默认占位符，等价于 _DEFAULT_PATTERN，但线性时间、不走正则。
+    依次产出每个占位符的 (start, end)。
+    """
+    pos = 0
+    n_open = len(_PLACEHOLDER_OPEN)
+    while True:
+        i = text.find(_PLACEHOLDER_OPEN, pos)
+        if i < 0:
+            return
+        j = i + n_open
+        if j >= len(text) or text[j] not in ":：":
+            pos = i + 1
+            continue
+        end = text.find(_PLACEHOLDER_CLOSE, j + 1)
+        if end < 0:
+            return
+
+        # 向前跳过空白，看前面是否紧跟 🖼️（不能越过上一个占位符）
+        start = i
+        k = i
+        while k > pos and text[k - 1].isspace():
+            k -= 1
+        p = k - len(_PLACEHOLDER_PREFIX)
+        if p >= pos and text.startswith(_PLACEHOLDER_PREFIX, p):
+            start = p
+
+        end += len(_PLACEHOLDER_CLOSE)
+        yield start, end
+        pos = end
+
+
+# 固定的 HTML 片段，只在替换时填入 base64 / 占位符文本
+_IMG_TMPL = "<img style='max-width:100%;border-radius:12px;' src='data:{};base64,{}'/>"
+_WRAP_TMPL = "<div style='margin:16px 0;'>{}</div>"
+_DEBUG_TMPL = (
+    "<div style='margin:16px 0;padding:12px;border:1px solid #333;border-radius:12px;'>"
+    "<div style='font-size:14px;opacity:.8;margin-bottom:8px;'>{}</div>"
+    "{}"
+    "</div>"
+)
+
+_HTML_HEAD = """<!doctype html>
+<html><head><meta charset="utf-8"/>
+<title>{}</title>
+</head>
+<body style="font-family:system-ui;line-height:1.6;padding:24px;max-width:900px;margin:0 auto;">
+<div style="white-space:normal;">"""
+_HTML_TAIL = """</div>
+</body></html>"""
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
 class ArticleEmbedImagesHTML:
     @classmethod
     def INPUT_TYPES(cls):
@@ -17,10 +90,14 @@ class ArticleEmbedImagesHTML:
             },
             "optional": {
                 # 匹配占位符：🖼️【图片位置：...】 / 【图片位置: ...】等
-                "pattern": ("STRING", {"default": r"(?:🖼️\s*)?【图片位置[:：]\s*.*?】"}),
+                # 默认值走手写扫描；自定义正则尽量别写多个 .*，长文章上回溯会很慢
+                "pattern": ("STRING", {"default": _DEFAULT_PATTERN}),
                 "title": ("STRING", {"default": "preview"}),
                 # 是否显示占位符那一行（红框那行）
                 "show_placeholder": ("BOOLEAN", {"default": False}),
+                # 预览图编码格式：JPEG/WEBP 编码快、体积小；PNG 无损
+                "image_format": (list(_MIME_TYPES.keys()), {"default": "JPEG"}),
+                "quality": ("INT", {"default": 85, "min": 1, "max": 100}),
             },
         }
 
@@ -38,6 +115,15 @@ class ArticleEmbedImagesHTML:
             return v[0] if len(v) > 0 else default
         return v
 
+    def _batch_size(self, images):
+        """只数图片张数，不做任何转换。"""
+        items = images if isinstance(images, list) else [images]
+        total = 0
+        for item in items:
+            shape = item.shape if hasattr(item, "shape") else np.shape(item)
+            total += 1 if len(shape) == 3 else int(shape[0])
+        return total
+
     def _to_numpy_batch(self, images):
         """
         把 ComfyUI 的 IMAGE 输入统一成 numpy float32 batch: [B,H,W,C] 范围 0..1
@@ -45,100 +131,148 @@ class ArticleEmbedImagesHTML:
           - 一个 batch tensor [B,H,W,C]
           - 单张 [H,W,C]
           - list[...]（上游产生了 list）
+        返回的总是新分配的数组，调用方可以原地修改。
         """
-        if isinstance(images, list):
-            batches = []
-            for item in images:
-                # item 可能是 torch tensor 或 numpy
-                arr = item.cpu().numpy() if hasattr(item, "cpu") else np.asarray(item)
-                if arr.ndim == 3:
-                    arr = arr[None, ...]
-                batches.append(arr)
-            if len(batches) == 0:
-                return np.zeros((0, 64, 64, 3), dtype=np.float32)
-            return np.concatenate(batches, axis=0).astype(np.float32)
-
-        arr = images.cpu().numpy() if hasattr(images, "cpu") else np.asarray(images)
-        if arr.ndim == 3:
-            arr = arr[None, ...]
-        return arr.astype(np.float32)
+        items = images if isinstance(images, list) else [images]
+
+        arrs = []
+        for item in items:
+            # item 可能是 torch tensor 或 numpy；CPU tensor 的 .numpy() 是视图，不拷贝
+            arr = item.cpu().numpy() if hasattr(item, "cpu") else np.asarray(item)
+            if arr.ndim == 3:
+                arr = arr[None, ...]
+            arrs.append(arr)
+        if len(arrs) == 0:
+            return np.zeros((0, 64, 64, 3), dtype=np.float32)
+
+        h, w, c = arrs[0].shape[1:]
+        for arr in arrs:
+            if arr.shape[1:] != (h, w, c):
+                raise ValueError(f"图片尺寸不一致：{arrs[0].shape[1:]} vs {arr.shape[1:]}")
+
+        # 预分配输出，逐个拷进对应位置（只分配一次）
+        out = np.empty((sum(arr.shape[0] for arr in arrs), h, w, c), dtype=np.float32)
+        off = 0
+        for arr in arrs:
+            b = arr.shape[0]
+            np.copyto(out[off:off + b], arr, casting="unsafe")
+            off += b
+        return out
 
     def run(
         self,
         article,
         images,
-        pattern=r"(?:🖼️\s*)?【图片位置[:：]\s*.*?】",
+        pattern=_DEFAULT_PATTERN,
         title="preview",
         show_placeholder=False,
+        image_format="JPEG",
+        quality=85,
     ):
         # 处理 INPUT_IS_LIST=True 时的 list 输入
         article = self._first(article, "")
-        pattern = self._first(pattern, r"(?:🖼️\s*)?【图片位置[:：]\s*.*?】")
+        pattern = self._first(pattern, _DEFAULT_PATTERN)
         title = self._first(title, "preview")
         show_placeholder = self._first(show_placeholder, False)
+        image_format = str(self._first(image_format, "JPEG")).upper()
+        quality = int(self._first(quality, 85))
+
+        if image_format not in _MIME_TYPES:
+            image_format = "JPEG"
+        mime = _MIME_TYPES[image_format]
 
         # 兼容 show_placeholder 传成 0/1 或 "true"/"false"
         if isinstance(show_placeholder, str):
             show_placeholder = show_placeholder.strip().lower() in ("1", "true", "yes", "y", "on")
 
-        # 统一图片 batch
-        imgs = self._to_numpy_batch(images)
-        batch = int(imgs.shape[0])
+        article = str(article)
+        pattern = str(pattern)
+        is_default = pattern in (_DEFAULT_PATTERN, _LEGACY_DEFAULT_PATTERN)
+
+        if is_default and _PLACEHOLDER_OPEN not in article:
+            # 文章里根本没有占位符：不用转换图片，只数一下张数
+            batch = self._batch_size(images)
+            imgs_u8 = None
+            spans = ()
+        else:
+            # 统一图片 batch
+            imgs = self._to_numpy_batch(images)
+            batch = int(imgs.shape[0])
+
+            # 整个 batch 一次性转 uint8，repl 里不再逐张生成 float 临时数组；
+            # _to_numpy_batch 返回的是新分配的缓冲区，直接原地 clip/缩放，不再多占一份 float
+            np.clip(imgs, 0.0, 1.0, out=imgs)
+            imgs *= 255.0
+            imgs += 0.5
+            imgs_u8 = imgs.astype(np.uint8)
+            del imgs
+
+            if is_default:
+                spans = _iter_default_placeholders(article)
+            else:
+                spans = (m.span() for m in _compile_pattern(pattern).finditer(article))
 
         idx = 0
         matched = 0
+        # 所有图片共用一个编码缓冲区，避免每张图重新分配、扩容
+        buf = BytesIO()
 
-        def repl(m):
+        def repl(text):
             nonlocal idx, matched
             matched += 1
 
+            # 占位符本身的换行也要转 <br/>
+            placeholder = text.replace("\n", "<br/>")
+
             # 如果占位符比图片多，多出来的不替换
             if idx >= batch:
-                return m.group(0)
+                return placeholder
 
-            arr = np.clip(imgs[idx] * 255.0, 0, 255).astype(np.uint8)
-            pil = Image.fromarray(arr)
+            pil = Image.fromarray(imgs_u8[idx])
 
-            buf = BytesIO()
-            pil.save(buf, format="PNG")
-            b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+            buf.seek(0)
+            if image_format == "PNG":
+                # 预览用途，compress_level=1 编码快很多，体积只大一点
+                pil.save(buf, format="PNG", compress_level=1)
+            else:
+                # JPEG 不支持 alpha，统一转 RGB
+                if pil.mode != "RGB":
+                    pil = pil.convert("RGB")
+                pil.save(buf, format=image_format, quality=quality)
+            n = buf.tell()
+            # getbuffer() 不拷贝，只取本次写入的前 n 字节（后面可能是上一张的残留）；base64 结果是纯 ASCII
+            with buf.getbuffer() as view, view[:n] as data:
+                b64 = b64encode(data).decode("ascii")
 
-            placeholder = m.group(0)
             idx += 1
 
-            img_html = f"<img style='max-width:100%;border-radius:12px;' src='data:image/png;base64,{b64}'/>"
+            img_html = _IMG_TMPL.format(mime, b64)
 
             if show_placeholder:
                 # 调试模式：显示占位符文本（红框那行）
-                return (
-                    f"<div style='margin:16px 0;padding:12px;border:1px solid #333;border-radius:12px;'>"
-                    f"<div style='font-size:14px;opacity:.8;margin-bottom:8px;'>{placeholder}</div>"
-                    f"{img_html}"
-                    f"</div>"
-                )
+                return _DEBUG_TMPL.format(placeholder, img_html)
 
             # 展示模式：只插图片，不显示占位符那行
-            return f"<div style='margin:16px 0;'>{img_html}</div>"
-
-        # 用正则顺序替换，确保第1/2/...占位符对应第1/2/...张图
-        html_article = re.sub(str(pattern), repl, str(article), flags=re.DOTALL)
+            return _WRAP_TMPL.format(img_html)
 
-        # 换行转 <br/>
-        html_body = html_article.replace("\n", "<br/>")
-
-        html = f"""<!doctype html>
-<html><head><meta charset="utf-8"/>
-<title>{title}</title>
-</head>
-<body style="font-family:system-ui;line-height:1.6;padding:24px;max-width:900px;margin:0 auto;">
-<div style="white-space:normal;">{html_body}</div>
-</body></html>"""
+        # 按顺序替换，确保第1/2/...占位符对应第1/2/...张图；
+        # 换行转 <br/> 在同一趟里完成，最后只 join 一次
+        parts = [_HTML_HEAD.format(title)]
+        pos = 0
+        for start, end in spans:
+            parts.append(article[pos:start].replace("\n", "<br/>"))
+            parts.append(repl(article[start:end]))
+            pos = end
+        parts.append(article[pos:].replace("\n", "<br/>"))
+        parts.append(_HTML_TAIL)
+        html = "".join(parts)
 
         out_dir = os.path.join(os.getcwd(), "output")
         os.makedirs(out_dir, exist_ok=True)
         html_path = os.path.join(out_dir, f"{title}.html")
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html)
+        # 先整体编码成 bytes，再一次性写入，绕开 TextIOWrapper 的分块编码
+        with open(html_path, "wb") as f:
+            f.write(html.encode("utf-8"))
 
         return (html_path, html, matched, batch)
 
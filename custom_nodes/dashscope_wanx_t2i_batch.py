@@ -1,38 +1,191 @@
 import json
 import time
 import io
-import urllib.request
+import threading
 import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from PIL import Image
 
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from torchvision.io import ImageReadMode, decode_image
+except ImportError:
+    decode_image = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# 同时进行中的任务 / 下载数上限
+_MAX_WORKERS = 8
+# 默认同时提交的任务数；DashScope 按账号限制提交频率和进行中的任务数，默认保守一点
+_DEFAULT_CONCURRENCY = 2
+
+# 轮询间隔指数退避：从 poll_interval_sec 开始每次 x1.5，最长不超过这个值
+_POLL_BACKOFF = 1.5
+_MAX_POLL_INTERVAL_SEC = 5.0
+
+# 有 urllib3 时复用 keep-alive 连接：轮询和下载不再每次重新握手 TCP+TLS
+# 不自动重试（失败由调用方处理），但和 urlopen 一样跟随重定向；Retry(other=...) 需要 urllib3>=1.26
+_POOL_KW = None
+if urllib3 is not None:
+    try:
+        _POOL_KW = {
+            "maxsize": 16,
+            "retries": urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=5),
+        }
+    except TypeError:
+        urllib3 = None
+
+_POOL = urllib3.PoolManager(**_POOL_KW) if urllib3 is not None else None
+# 代理地址 -> ProxyManager
+_PROXY_POOLS = {}
+_PROXY_POOLS_LOCK = threading.Lock()
+
+
+def _sleep_before(delay, deadline):
+    # 退避等待，但不睡过 deadline
+    time.sleep(max(0.0, min(delay, deadline - time.time())))
+
+
+def _json_dumps(obj) -> bytes:
+    # orjson 是 C 实现，直接产出 UTF-8 bytes；没装就退回标准库（紧凑分隔符）
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(raw):
+    # raw 可以是 bytes 或 str
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+class _HTTPStatusError(Exception):
+    def __init__(self, code, body):
+        super().__init__(f"HTTP {code}: {body}")
+        self.code = code
+        self.body = body
+
+
+def _get_pool(url):
+    """
+    选连接池：和 urlopen 一样遵循 HTTPS_PROXY / HTTP_PROXY / NO_PROXY。
+    返回 None 表示走 urlopen（没装 urllib3，或代理类型 urllib3 不支持）。
+    """
+    if urllib3 is None:
+        return None
+    parts = urllib.parse.urlsplit(url)
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.netloc):
+        return _POOL
+
+    if "://" not in proxy:
+        proxy = f"http://{proxy}"
+    if urllib.parse.urlsplit(proxy).scheme not in ("http", "https"):
+        return None
+    with _PROXY_POOLS_LOCK:
+        pool = _PROXY_POOLS.get(proxy)
+        if pool is None:
+            pool = _PROXY_POOLS[proxy] = urllib3.ProxyManager(proxy, **_POOL_KW)
+        return pool
+
+
+def _request(method, url, headers=None, body=None, timeout=60):
+    pool = _get_pool(url)
+    if pool is None:
+        req = urllib.request.Request(url, data=body, headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return resp.read()
+        except urllib.error.HTTPError as e:
+            raise _HTTPStatusError(e.code, e.read().decode("utf-8", errors="ignore"))
+
+    resp = pool.request(method, url, body=body, headers=headers, timeout=timeout, preload_content=True)
+    if resp.status >= 400:
+        raise _HTTPStatusError(resp.status, resp.data.decode("utf-8", errors="ignore"))
+    return resp.data
+
 
 def _http_json(url, method="GET", headers=None, body_obj=None, timeout=60):
     headers = headers or {}
     data = None
     if body_obj is not None:
-        data = json.dumps(body_obj, ensure_ascii=False).encode("utf-8")
+        data = _json_dumps(body_obj)
         headers = {**headers, "Content-Type": "application/json"}
 
-    req = urllib.request.Request(url, data=data, headers=headers, method=method)
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        raw = resp.read().decode("utf-8")
-        return json.loads(raw)
+    return _json_loads(_request(method, url, headers=headers, body=data, timeout=timeout))
 
 
 def _download_bytes(url, timeout=120):
-    req = urllib.request.Request(url, method="GET")
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return resp.read()
+    return _request("GET", url, timeout=timeout)
+
+
+def _parse_size(size):
+    """"1024*1024"（宽*高）-> (H, W)；解析不了返回 None。"""
+    try:
+        w, h = (int(x) for x in str(size).split("*"))
+    except ValueError:
+        return None
+    if w <= 0 or h <= 0:
+        return None
+    return h, w
+
+
+def _decode_rgb_u8(img_bytes: bytes) -> torch.Tensor:
+    # 解码成 uint8 [H,W,3]
+    if decode_image is not None:
+        try:
+            # torchvision 直接用 libjpeg-turbo / libpng 解码，返回 [3,H,W] uint8
+            chw = decode_image(torch.frombuffer(bytearray(img_bytes), dtype=torch.uint8), mode=ImageReadMode.RGB)
+            # 新版 torchvision 对 16 位 PNG 返回 uint16，这里只接 uint8，其他交给 cv2 / PIL 转 8 位
+            if chw.dtype == torch.uint8:
+                return chw.permute(1, 2, 0)
+        except Exception:
+            # 格式不支持等情况退回 cv2 / PIL
+            pass
 
+    if cv2 is not None:
+        # cv2 同样走 libjpeg-turbo；返回 BGR，原地转成 RGB（负步长切片 torch 不支持）
+        # 忽略 EXIF 方向，和 torchvision / PIL 两条路径的输出保持一致
+        bgr = cv2.imdecode(
+            np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+        if bgr is not None:
+            return torch.from_numpy(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr))
 
-def _bytes_to_comfy_image(img_bytes: bytes) -> torch.Tensor:
-    # ComfyUI IMAGE: float32, [B,H,W,3], range 0..1
     img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    arr = np.array(img).astype(np.float32) / 255.0
-    return torch.from_numpy(arr)[None, ...]  # [1,H,W,3]
+    return torch.from_numpy(np.array(img, dtype=np.uint8))
+
+
+def _u8_to_comfy_image(u8: torch.Tensor, out=None) -> torch.Tensor:
+    """
+    uint8 [H,W,3] -> ComfyUI IMAGE: float32, [B,H,W,3], range 0..1，返回 [1,H,W,3]。
+    传了 out（同尺寸的 [H,W,3] float32）时直接写进 out，不再另外分配。
+    """
+    if out is not None:
+        # copy_ 顺带完成 uint8 -> float32，再原地缩放
+        out.copy_(u8).div_(255.0)
+        return out.unsqueeze(0)
+    # 转 float 和缩放合成一次原地操作，少一份临时数组
+    return u8.to(torch.float32, memory_format=torch.contiguous_format).div_(255.0).unsqueeze_(0)
 
 
 class DashScopeWanxText2ImageBatch:
@@ -56,7 +209,11 @@ class DashScopeWanxText2ImageBatch:
                 "base_host": ("STRING", {"default": "dashscope.aliyuncs.com"}),
                 "poll_interval_sec": ("FLOAT", {"default": 1.0, "min": 0.2, "max": 10.0}),
                 "timeout_sec": ("INT", {"default": 120, "min": 10, "max": 600}),
-            }
+            },
+            "optional": {
+                # 同时提交/轮询的 prompt 数，账号限流严格时调成 1（逐条执行）
+                "max_concurrency": ("INT", {"default": _DEFAULT_CONCURRENCY, "min": 1, "max": _MAX_WORKERS}),
+            },
         }
 
     RETURN_TYPES = ("IMAGE", "STRING", "INT")
@@ -77,10 +234,11 @@ class DashScopeWanxText2ImageBatch:
         base_host,
         poll_interval_sec,
         timeout_sec,
+        max_concurrency=_DEFAULT_CONCURRENCY,
     ):
         # 1) 解析 prompts_json -> list[str]
         try:
-            prompts = json.loads(prompts_json)
+            prompts = _json_loads(prompts_json)
         except Exception as e:
             raise RuntimeError(f"prompts_json 不是合法JSON：{e}")
 
@@ -89,7 +247,7 @@ class DashScopeWanxText2ImageBatch:
         if not isinstance(prompts, list) or not all(isinstance(x, str) for x in prompts):
             raise RuntimeError("prompts_json 必须是 JSON 字符串数组，例如：[\"描述1\",\"描述2\"]")
 
-        # 2) 逐条 prompt 调万相
+        # 2) 并发调万相：每条 prompt 的创建/轮询/下载都在线程里跑（基本都在等网络）
         headers_post = {
             "Authorization": f"Bearer {api_key}",
             "X-DashScope-Async": "enable",
@@ -99,10 +257,40 @@ class DashScopeWanxText2ImageBatch:
         }
 
         create_url = f"https://{base_host}/api/v1/services/aigc/text2image/image-synthesis"
-        images_tensors = []
-        urls = []
 
-        for prompt in prompts:
+        # 每条 prompt 一个槽位，线程只写自己的下标，不需要加锁，顺序天然和 prompts 一致
+        images_tensors = [[] for _ in prompts]
+        urls = [[] for _ in prompts]
+
+        # 按请求的 size 准备整个输出 batch，下载的图直接解码进对应位置，省掉最后的 torch.cat；
+        # 第一张尺寸相符的图下载完才分配，任务全失败时不白占内存
+        n = int(n_per_prompt)
+        total = len(prompts) * n
+        hw = _parse_size(size)
+        batch_out = None
+        batch_lock = threading.Lock()
+        # 每个位置是否已直接写入 batch_out；各线程只写自己的下标
+        filled = [False] * total
+
+        def _get_batch_out():
+            nonlocal batch_out
+            with batch_lock:
+                if batch_out is None:
+                    batch_out = torch.empty((total, hw[0], hw[1], 3), dtype=torch.float32)
+                return batch_out
+
+        # 下载单独一个线程池，避免 prompt 线程占满后互相等待
+        download_ex = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+
+        def _fetch(slot, u):
+            u8 = _decode_rgb_u8(_download_bytes(u, timeout=120))
+            if slot is not None and hw is not None and tuple(u8.shape[:2]) == hw:
+                t = _u8_to_comfy_image(u8, out=_get_batch_out()[slot])
+                filled[slot] = True
+                return t, u
+            return _u8_to_comfy_image(u8), u
+
+        def _run_one(i, prompt):
             payload = {
                 "model": model,
                 "input": {
@@ -118,14 +306,24 @@ class DashScopeWanxText2ImageBatch:
             if negative_prompt.strip():
                 payload["input"]["negative_prompt"] = negative_prompt
 
-            # 2.1 创建任务 -> task_id
-            try:
-                resp = _http_json(create_url, method="POST", headers=headers_post, body_obj=payload, timeout=60)
-            except urllib.error.HTTPError as e:
-                msg = e.read().decode("utf-8", errors="ignore") if hasattr(e, "read") else str(e)
-                raise RuntimeError(f"创建任务失败(HTTP {e.code}): {msg}")
-            except Exception as e:
-                raise RuntimeError(f"创建任务失败: {e}")
+            max_delay = max(poll_interval_sec, _MAX_POLL_INTERVAL_SEC)
+            # 创建（含限流重试）+ 轮询共用一个截止时间
+            deadline = time.time() + timeout_sec
+
+            # 2.1 创建任务 -> task_id；被限流（HTTP 429）时退避重试，直到 deadline
+            delay = poll_interval_sec
+            while True:
+                try:
+                    resp = _http_json(create_url, method="POST", headers=headers_post, body_obj=payload, timeout=60)
+                    break
+                except _HTTPStatusError as e:
+                    if e.code == 429 and time.time() < deadline:
+                        _sleep_before(delay, deadline)
+                        delay = min(delay * _POLL_BACKOFF, max_delay)
+                        continue
+                    raise RuntimeError(f"创建任务失败(HTTP {e.code}): {e.body}")
+                except Exception as e:
+                    raise RuntimeError(f"创建任务失败: {e}")
 
             task_id = None
             # 常见结构：resp["output"]["task_id"]
@@ -136,17 +334,18 @@ class DashScopeWanxText2ImageBatch:
 
             # 2.2 轮询任务
             status_url = f"https://{base_host}/api/v1/tasks/{task_id}"
-            t0 = time.time()
             final = None
+            delay = poll_interval_sec
             while True:
-                if time.time() - t0 > timeout_sec:
+                if time.time() >= deadline:
                     raise RuntimeError(f"任务超时：{task_id}")
 
                 try:
                     sresp = _http_json(status_url, method="GET", headers=headers_get, timeout=60)
                 except Exception as e:
                     # 网络抖动就等等再试
-                    time.sleep(poll_interval_sec)
+                    _sleep_before(delay, deadline)
+                    delay = min(delay * _POLL_BACKOFF, max_delay)
                     continue
 
                 out = (sresp.get("output") or {}) if isinstance(sresp, dict) else {}
@@ -158,27 +357,52 @@ class DashScopeWanxText2ImageBatch:
                 if task_status in ("FAILED", "CANCELED", "CANCELLED"):
                     raise RuntimeError(f"任务失败：{task_id}，返回：{sresp}")
 
-                time.sleep(poll_interval_sec)
+                _sleep_before(delay, deadline)
+                delay = min(delay * _POLL_BACKOFF, max_delay)
 
-            # 2.3 下载结果图片
+            # 2.3 下载结果图片（同一条 prompt 的多张图也并发下载）
             out = final.get("output") or {}
             results = out.get("results") or []
             if not isinstance(results, list) or len(results) == 0:
                 raise RuntimeError(f"任务成功但没有 results：{final}")
 
+            result_urls = []
             for r in results:
                 u = r.get("url") if isinstance(r, dict) else None
-                if not u:
-                    continue
-                img_bytes = _download_bytes(u, timeout=120)
-                images_tensors.append(_bytes_to_comfy_image(img_bytes))
-                urls.append(u)
+                if u:
+                    result_urls.append(u)
+            # 第 i 条 prompt 占 [i*n, i*n+n) 这些位置；返回数量超出 n 时不走预分配
+            if len(result_urls) <= n:
+                slots = [i * n + k for k in range(len(result_urls))]
+            else:
+                slots = [None] * len(result_urls)
+            for t, u in download_ex.map(_fetch, slots, result_urls):
+                images_tensors[i].append(t)
+                urls[i].append(u)
+
+        n_workers = max(1, min(int(max_concurrency), _MAX_WORKERS, len(prompts)))
+        try:
+            with ThreadPoolExecutor(max_workers=n_workers) as prompt_ex:
+                # 消费结果，让线程里的异常在这里抛出
+                for _ in prompt_ex.map(_run_one, range(len(prompts)), prompts):
+                    pass
+        finally:
+            download_ex.shutdown()
+
+        images_tensors = [t for sub in images_tensors for t in sub]
+        urls = [u for sub in urls for u in sub]
 
         if not images_tensors:
             raise RuntimeError("没有生成任何图片（images_tensors 为空）")
 
-        batch = torch.cat(images_tensors, dim=0)  # [B,H,W,3]
-        return (batch, json.dumps(urls, ensure_ascii=False), int(batch.shape[0]))
+        # 每个位置都直接写进了 batch_out 时直接用它；否则（尺寸不符、数量不一致等）退回 cat
+        if batch_out is not None and all(filled):
+            batch = batch_out
+        else:
+            # 先放掉对整块 batch_out 的引用，它只靠已写入那几张图的视图撑到 cat 结束
+            batch_out = None
+            batch = torch.cat(images_tensors, dim=0)  # [B,H,W,3]
+        return (batch, _json_dumps(urls).decode("utf-8"), int(batch.shape[0]))
 
 
 NODE_CLASS_MAPPINGS = {
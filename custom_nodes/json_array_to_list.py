@@ -1,5 +1,11 @@
 import json
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 class JSONArrayToStringList:
     @classmethod
     def INPUT_TYPES(cls):
@@ -12,8 +18,8 @@ class JSONArrayToStringList:
     CATEGORY = "utils"
 
     def run(self, json_array):
-        data = json.loads(json_array)
-        if not isinstance(data, list):
+        data = _loads(json_array)
+        if type(data) is not list:
             raise ValueError("Input is not a JSON array")
         return (data,)
 